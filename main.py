@@ -1,10 +1,21 @@
 import os
-import base64
-from io import BytesIO
-from typing import List, Optional
-
-from fastapi import FastAPI, Header, HTTPException
-from pydantic import BaseModel
+import re
+import json
+import hmac
+import zlib
+from functools import lru_cache
+from typing import List, Literal, Optional
+
+try:
+    # base64 com SIMD (AVX2/NEON); mesma API do módulo padrão
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+from anyio import CapacityLimiter, to_thread
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict
 
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
 from reportlab.platypus.tableofcontents import TableOfContents
@@ -12,141 +23,344 @@ from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.lib import colors
 from reportlab.lib.units import cm
 from reportlab.lib.pagesizes import A4, letter
+from reportlab.pdfbase import pdfdoc, pdfmetrics
 
 
 app = FastAPI(title="Ebook PDF Generator API", version="5.0.0")
 
+# Nível do zlib nos streams do PDF (-1 = padrão do zlib; 1 = mais rápido, PDF maior)
+PDF_ZLIB_LEVEL = int(os.getenv("PDF_ZLIB_LEVEL", "-1"))
+if not -1 <= PDF_ZLIB_LEVEL <= 9:
+    raise RuntimeError(f"PDF_ZLIB_LEVEL must be between -1 and 9, got {PDF_ZLIB_LEVEL}")
+
+
+class LeveledZCompress(pdfdoc.PDFStreamFilterZCompress):
+    def encode(self, text):
+        if isinstance(text, str):
+            text = text.encode("utf8")
+        return zlib.compress(text, PDF_ZLIB_LEVEL)
+
+
+# O pdfdoc busca PDFZCompress pelo nome do módulo a cada stream
+if PDF_ZLIB_LEVEL != -1:
+    pdfdoc.PDFZCompress = LeveledZCompress()
+
 API_KEY = os.getenv("API_KEY", "").strip()
+API_KEY_BYTES = API_KEY.encode()
+
+PDF_FILENAME = "ebook_premium.pdf"
+
+PAGE_SIZES = {"A4": A4, "letter": letter, "Letter": letter}
+
+# Quantos PDFs prontos manter em memória, indexados pelo payload
+PDF_CACHE_SIZE = int(os.getenv("PDF_CACHE_SIZE", "32"))
+
+# Quantos PDFs cada worker monta ao mesmo tempo, para não estourar memória em
+# rajadas. O limite é por processo: com --workers N, o host monta até
+# N * PDF_BUILD_CONCURRENCY PDFs simultâneos.
+PDF_BUILD_CONCURRENCY = int(os.getenv("PDF_BUILD_CONCURRENCY", "1"))
+if PDF_BUILD_CONCURRENCY < 1:
+    raise RuntimeError(
+        f"PDF_BUILD_CONCURRENCY must be at least 1, got {PDF_BUILD_CONCURRENCY}"
+    )
+BUILD_LIMITER = CapacityLimiter(PDF_BUILD_CONCURRENCY)
+
+# múltiplo de 3 (e de 57) para que cada pedaço vire base64 sem padding no meio
+B64_CHUNK_SIZE = 57 * 1024
+
+# Envelope openaiFileResponse em volta do base64 (que já é ASCII seguro em JSON)
+B64_ENVELOPE_PREFIX = (
+    '{"openaiFileResponse":[{"name":"%s","mime_type":"application/pdf","content":"'
+    % PDF_FILENAME
+).encode("ascii")
+B64_ENVELOPE_SUFFIX = b'"}]}'
+
+# Nível do gzip do envelope base64: quase a taxa do 9, metade da CPU
+B64_GZIP_LEVEL = 6
+
+# ================= ESTILOS =================
+# Construídos uma única vez por processo; não dependem do payload.
+PRIMARY = colors.HexColor("#0B1F3A")
+
+STYLES = getSampleStyleSheet()
+
+TITLE_STYLE = ParagraphStyle(
+    name="TitleStyle",
+    parent=STYLES["Heading1"],
+    fontSize=26,
+    textColor=PRIMARY,
+    spaceAfter=16,
+)
+
+SUBTITLE_STYLE = STYLES["Normal"]
+TOC_HEADER_STYLE = STYLES["Heading2"]
+
+TOC_LEVEL1_STYLE = ParagraphStyle(
+    name="TOCLevel1",
+    fontSize=11,
+    leftIndent=20,
+    firstLineIndent=-20,
+    spaceBefore=5,
+)
+
+CHAPTER_STYLE = ParagraphStyle(
+    name="ChapterTitle",
+    parent=STYLES["Heading2"],
+    fontSize=18,
+    textColor=PRIMARY,
+    spaceAfter=10,
+)
+
+BODY_STYLE = ParagraphStyle(
+    name="BodyTextPremium",
+    parent=STYLES["Normal"],
+    fontSize=11.5,
+    leading=18,
+    spaceAfter=10,
+)
+
+# Linhas internas de um bloco: mesmo corpo de texto, sem espaço depois
+BODY_LINE_STYLE = ParagraphStyle(
+    name="BodyTextPremiumLine",
+    parent=BODY_STYLE,
+    spaceAfter=0,
+)
+
+# Força o carregamento das métricas das fontes na importação, e não na
+# primeira requisição
+pdfmetrics.registerFontFamily(
+    "Helvetica",
+    normal="Helvetica",
+    bold="Helvetica-Bold",
+    italic="Helvetica-Oblique",
+    boldItalic="Helvetica-BoldOblique",
+)
+for _style in (TITLE_STYLE, TOC_LEVEL1_STYLE, CHAPTER_STYLE, BODY_STYLE):
+    Paragraph("<b>aquecimento</b> <i>aquecimento</i>", _style).wrap(100, 100)
 
 
 class Chapter(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     title: str
     content: str
 
 
 class EbookRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     title: str
     subtitle: Optional[str] = None
     author: Optional[str] = None
     page_size: Optional[str] = "A4"
+    include_toc: bool = True
     chapters: List[Chapter]
 
 
-def get_page_size(size):
-    return A4 if size == "A4" else letter
+# Um parágrafo por bloco: Paragraphs pequenos quebram linha e página bem mais rápido
+BLANK_LINE_RE = re.compile(r"\n[ \t\r]*\n")
+
+
+def safe_text_to_paragraph_html(text):
+    # Escapa texto do usuário (título, subtítulo, autor, capítulos) para o
+    # Paragraph: tudo é texto puro, sem marcação. str.replace encadeado é ~18x
+    # mais rápido que str.translate, que cai no caminho lento com
+    # substituições de vários chars.
+    if text is None:
+        return ""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+# "Capítulo 3: Título", "capitulo III - Título" -> "Título"; "Capítulo 3" -> ""
+# Só aceita número arábico ou romano bem formado, para não comer palavras como
+# "Civil" ou "Mil".
+CAPITULO_PREFIX_RE = re.compile(
+    r"^\s*cap[ií]tulo\s+"
+    r"(?:\d+|m{0,3}(?:cm|cd|d?c{0,3})(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3}))"
+    r"(?<=[0-9mdclxvi])\b"
+    r"\s*[:\-–—]?\s*(.*)$",
+    re.IGNORECASE,
+)
+
+
+def strip_capitulo_prefix(title):
+    # Título só com o prefixo vira "" (o cabeçalho fica "Capítulo N")
+    title = (title or "").strip()
+    m = CAPITULO_PREFIX_RE.match(title)
+    return m.group(1).strip() if m else title
+
+
+class PDFSink:
+    # O ReportLab grava o PDF inteiro num único write(); guardar o que chega e
+    # juntar no fim devolve os mesmos bytes, sem as duas cópias do BytesIO
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+
+def check_auth(authorization):
+    if not API_KEY:
+        return
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Missing Bearer token")
+    token = authorization[len("Bearer "):].strip()
+    # Comparação em tempo constante; em bytes para aceitar tokens não-ASCII
+    if not hmac.compare_digest(token.encode(), API_KEY_BYTES):
+        raise HTTPException(status_code=403, detail="Invalid token")
+
+
+def iter_pdf_base64_json(pdf_bytes):
+    # Monta o envelope openaiFileResponse em pedaços, sem materializar a string base64 inteira
+    yield B64_ENVELOPE_PREFIX
+    # memoryview: fatiar não copia o PDF antes de codificar
+    view = memoryview(pdf_bytes)
+    for start in range(0, len(view), B64_CHUNK_SIZE):
+        yield base64.b64encode(view[start:start + B64_CHUNK_SIZE])
+    yield B64_ENVELOPE_SUFFIX
+
+
+def content_blocks(content):
+    # Blocos do conteúdo (separados por linha em branco), cada um como a lista
+    # das suas linhas já escapadas para o Paragraph
+    return [
+        [
+            safe_text_to_paragraph_html(line.removesuffix("\r"))
+            for line in block.strip("\r\n").split("\n")
+        ]
+        for block in BLANK_LINE_RE.split(content)
+        if block.strip()
+    ]
 
 
-@app.post("/generate-ebook-pdf")
-def generate_ebook_pdf(payload: EbookRequest, authorization: str = Header(default="")):
+def iter_pdf_base64_json_gzip(pdf_bytes):
+    # Gerador síncrono: o StreamingResponse o itera no threadpool, então a
+    # compressão não roda no event loop (ao contrário do GZipMiddleware)
+    gz = zlib.compressobj(B64_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in iter_pdf_base64_json(pdf_bytes):
+        if compressed := gz.compress(chunk):
+            yield compressed
+    yield gz.flush()
 
-    # Autenticação
-    # if API_KEY:
-#     if not authorization.startswith("Bearer "):
-#         raise HTTPException(status_code=401, detail="Missing Bearer token")
-#     token = authorization.replace("Bearer ", "").strip()
-#     if token != API_KEY:
-#         raise HTTPException(status_code=403, detail="Invalid token")
 
-    buffer = BytesIO()
+def load_payload(payload_json):
+    # O payload já foi validado pela rota; aqui só reidrata, sem revalidar
+    data = json.loads(payload_json)
+    data["chapters"] = [Chapter.model_construct(**c) for c in data["chapters"]]
+    return EbookRequest.model_construct(**data)
+
+
+def chapter_elements(i, ch):
+    clean_title = strip_capitulo_prefix(ch.title)
+
+    chapter_title = f"Capítulo {i}"
+    if clean_title:
+        chapter_title += f": {safe_text_to_paragraph_html(clean_title)}"
+
+    heading = Paragraph(chapter_title, CHAPTER_STYLE)
+    heading._bookmarkName = f"ch_{i}"
+
+    # Spacer/PageBreak novos a cada capítulo: o Platypus marca _postponed no
+    # próprio flowable quando ele não cabe na página, e reaproveitar a mesma
+    # instância gera LayoutError ("too large on page")
+    elements = [heading, Spacer(1, 0.3 * cm)]
+
+    # Uma linha por Paragraph em vez de <br/>: sem <br/> o breakLines do
+    # ReportLab usa o caminho rápido de fragmento único (~2x no layout)
+    for *lines, last in content_blocks(ch.content):
+        elements.extend(Paragraph(line, BODY_LINE_STYLE) for line in lines)
+        elements.append(Paragraph(last, BODY_STYLE))
+
+    elements.append(PageBreak())
+    return elements
+
+
+@lru_cache(maxsize=PDF_CACHE_SIZE)
+def build_pdf(payload_json):
+    # Recebe o payload serializado para que payloads idênticos reaproveitem o PDF
+    payload = load_payload(payload_json)
+
+    buffer = PDFSink()
 
     doc = SimpleDocTemplate(
         buffer,
-        pagesize=get_page_size(payload.page_size),
+        pagesize=PAGE_SIZES.get(payload.page_size, A4),
         rightMargin=2.5 * cm,
         leftMargin=2.5 * cm,
         topMargin=2.5 * cm,
         bottomMargin=2.5 * cm,
     )
 
-    styles = getSampleStyleSheet()
     elements = []
 
     # ================= CAPA =================
-    title_style = ParagraphStyle(
-        name="TitleStyle",
-        parent=styles["Heading1"],
-        fontSize=26,
-        textColor=colors.HexColor("#0B1F3A"),
-        spaceAfter=16,
-    )
-
     elements.append(Spacer(1, 6 * cm))
-    elements.append(Paragraph(payload.title, title_style))
+    elements.append(Paragraph(safe_text_to_paragraph_html(payload.title), TITLE_STYLE))
 
     if payload.subtitle:
         elements.append(Spacer(1, 0.5 * cm))
-        elements.append(Paragraph(payload.subtitle, styles["Normal"]))
+        subtitle = safe_text_to_paragraph_html(payload.subtitle)
+        elements.append(Paragraph(subtitle, SUBTITLE_STYLE))
 
     if payload.author:
         elements.append(Spacer(1, 1 * cm))
-        elements.append(Paragraph(f"Autor: {payload.author}", styles["Normal"]))
+        author = safe_text_to_paragraph_html(payload.author)
+        elements.append(Paragraph(f"Autor: {author}", SUBTITLE_STYLE))
 
     elements.append(PageBreak())
 
     # ================= SUMÁRIO =================
-    elements.append(Paragraph("Sumário", styles["Heading2"]))
-    elements.append(Spacer(1, 0.5 * cm))
-
-    toc = TableOfContents()
-    toc.levelStyles = [
-        ParagraphStyle(
-            name="TOCLevel1",
-            fontSize=11,
-            leftIndent=20,
-            firstLineIndent=-20,
-            spaceBefore=5,
-        )
-    ]
-
-    elements.append(toc)
-    elements.append(PageBreak())
+    if payload.include_toc:
+        elements.append(Paragraph("Sumário", TOC_HEADER_STYLE))
+        elements.append(Spacer(1, 0.5 * cm))
 
-    # ================= CAPÍTULOS =================
-    chapter_style = ParagraphStyle(
-        name="ChapterTitle",
-        parent=styles["Heading2"],
-        fontSize=18,
-        textColor=colors.HexColor("#0B1F3A"),
-        spaceAfter=10,
-    )
+        toc = TableOfContents()
+        toc.levelStyles = [TOC_LEVEL1_STYLE]
 
-    body_style = ParagraphStyle(
-        name="BodyTextPremium",
-        parent=styles["Normal"],
-        fontSize=11.5,
-        leading=18,
-        spaceAfter=10,
-    )
+        elements.append(toc)
+        elements.append(PageBreak())
 
+    # ================= CAPÍTULOS =================
     for i, ch in enumerate(payload.chapters, start=1):
+        elements.extend(chapter_elements(i, ch))
 
-        clean_title = ch.title.replace("Capítulo", "").strip()
-
-        chapter_title = f"Capítulo {i}: {clean_title}"
-
-        heading = Paragraph(chapter_title, chapter_style)
-        heading._bookmarkName = f"ch_{i}"
+    # ================= BUILD =================
+    doc.build(elements)
 
-        elements.append(heading)
-        elements.append(Spacer(1, 0.3 * cm))
+    return buffer.getvalue()
 
-        content_html = ch.content.replace("\n", "<br/>")
-        elements.append(Paragraph(content_html, body_style))
 
-        elements.append(PageBreak())
+@app.post("/generate-ebook-pdf")
+async def generate_ebook_pdf(
+    payload: EbookRequest,
+    authorization: str = Header(default=""),
+    encoding: Literal["base64", "pdf"] = Query(default="base64"),
+    accept_encoding: str = Header(default="", include_in_schema=False),
+):
 
-    # ================= BUILD =================
-    doc.build(elements)
+    # Autenticação
+    # check_auth(authorization)
 
-    pdf_bytes = buffer.getvalue()
-    b64 = base64.b64encode(pdf_bytes).decode("utf-8")
+    # O ReportLab é síncrono e pesado: roda fora do event loop
+    pdf_bytes = await to_thread.run_sync(
+        build_pdf, payload.model_dump_json(), limiter=BUILD_LIMITER
+    )
 
-    return {
-        "openaiFileResponse": [
-            {
-                "name": "ebook_premium.pdf",
-                "mime_type": "application/pdf",
-                "content": b64,
-            }
-        ]
-    }
+    if encoding == "base64":
+        # Só o envelope é comprimido: os streams do PDF puro já saem em Flate
+        headers = {"Vary": "Accept-Encoding"}
+        body = iter_pdf_base64_json(pdf_bytes)
+        if "gzip" in accept_encoding.lower():
+            headers["Content-Encoding"] = "gzip"
+            body = iter_pdf_base64_json_gzip(pdf_bytes)
+        return StreamingResponse(body, media_type="application/json", headers=headers)
+
+    return Response(
+        pdf_bytes,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename={PDF_FILENAME}"},
+    )